@@ -0,0 +1,418 @@
+"""Kronecker-factored approximate curvature (KFAC) for training a multi-layer
+   perceptron to classify MNIST digits, following Martens & Grosse (2015),
+   https://arxiv.org/abs/1503.05671"""
+from __future__ import absolute_import, division
+from __future__ import print_function
+
+import scipy.linalg
+import scipy.linalg.blas
+
+import autograd.numpy as np
+import autograd.numpy.random as npr
+from autograd.scipy.special import logsumexp
+from autograd import grad, jacobian
+from autograd.misc.flatten import flatten
+from data import load_mnist
+
+
+### MLP forward pass
+
+def init_random_params(scale, layer_sizes, rs=npr.RandomState(0),
+                       dtype=np.float32):
+    """Build a list of (weights, biases) tuples, one for each layer in the
+       net. Single precision is plenty for a damped preconditioner and
+       halves the memory traffic of every GEMM and factor update."""
+    return [(np.asarray(scale * rs.randn(m, n), dtype=dtype),  # weight matrix
+             np.asarray(scale * rs.randn(n), dtype=dtype))     # bias vector
+            for m, n in zip(layer_sizes[:-1], layer_sizes[1:])]
+
+def mlp(params, inputs):
+    """Unnormalized class log-probabilities of a tanh MLP.
+       params is a list of (weights, bias) tuples.
+       inputs is an (N x D) matrix."""
+    for W, b in params:
+        outputs = np.dot(inputs, W) + b
+        inputs = np.tanh(outputs)
+    return outputs
+
+def fast_logsumexp(X):
+    """Numerically stable logsumexp over the rows of a 2-D array, taking the
+       exponentials and logs in place on a single scratch copy. Only for
+       plain ndarrays on the statistics path; the differentiated objective
+       goes through autograd's logsumexp."""
+    m = np.max(X, axis=1, keepdims=True)
+    Y = X - m
+    np.exp(Y, out=Y)
+    s = np.sum(Y, axis=1, keepdims=True)
+    np.log(s, out=s)
+    s += m
+    return s
+
+def softmax(logits):
+    """Softmax over the rows of a 2-D array of plain ndarray logits (never
+       differentiated through)."""
+    Y = logits - fast_logsumexp(logits)
+    return np.exp(Y, out=Y)
+
+def log_likelihood(logits, targets):
+    return np.sum(targets * (logits - logsumexp(logits, axis=-1, keepdims=True)))
+
+_infer_buffers = {}
+
+def mlp_infer(params, inputs):
+    """Inference-only forward pass: each layer's GEMM writes straight into a
+       cached output buffer and the bias add and tanh are applied in place,
+       so repeated evaluation at a fixed batch size allocates nothing. Only
+       for plain ndarrays; anything differentiated goes through mlp."""
+    key = (inputs.shape[0], tuple(b.shape[0] for W, b in params))
+    bufs = _infer_buffers.get(key)
+    if bufs is None:
+        bufs = _infer_buffers[key] = [np.empty((inputs.shape[0], b.shape[0]),
+                                               dtype=b.dtype)
+                                      for W, b in params]
+    for (W, b), out in zip(params[:-1], bufs[:-1]):
+        np.dot(inputs, W, out=out)
+        out += b
+        np.tanh(out, out=out)
+        inputs = out
+    W, b = params[-1]
+    out = np.dot(inputs, W, out=bufs[-1])
+    out += b
+    return out
+
+def accuracy(params, inputs, target_class):
+    """target_class holds the integer class of each example; the labels
+       never change between evaluations, so callers precompute it once
+       with np.argmax(targets, axis=1) instead of re-reducing the one-hot
+       matrix on every call."""
+    predicted_class = np.argmax(mlp_infer(params, inputs), axis=1)
+    return np.mean(predicted_class == target_class)
+
+
+### Estimating the Kronecker factors
+
+def sym_outer(X):
+    """X^T X via the BLAS syrk routine, which fills only one triangle (half
+       the flops of a general matmul), mirrored back to a full matrix."""
+    syrk, = scipy.linalg.blas.get_blas_funcs(('syrk',), (X,))
+    S = syrk(1.0, X, trans=1)
+    return S + np.triu(S, 1).T
+
+def homog_outer(X):
+    """sym_outer of X with a homogeneous column of ones appended (so biases
+       ride along with the weights), without materializing the padded copy:
+       the ones column only contributes a border of column sums and a corner
+       count."""
+    s = np.sum(X, axis=0)
+    top = np.concatenate((sym_outer(X), s[:, None]), axis=1)
+    bottom = np.concatenate((s, np.array([X.shape[0]], dtype=X.dtype)))
+    return np.concatenate((top, bottom[None, :]), axis=0)
+
+_one_hot_rows = {}
+
+def sample_discrete_from_log(logprobs, rs):
+    """Sample one class label per row of unnormalized log-probabilities,
+       returned as one-hot vectors, by the Gumbel-max trick: the argmax of
+       the logits plus Gumbel noise is a draw from the softmax. The identity
+       matrix backing the one-hot lookup is built once per (K, dtype)."""
+    gumbels = rs.gumbel(size=logprobs.shape)
+    labels = np.argmax(logprobs + gumbels, axis=1)
+    key = (logprobs.shape[1], logprobs.dtype.name)
+    eye = _one_hot_rows.get(key)
+    if eye is None:
+        eye = _one_hot_rows[key] = np.eye(key[0], dtype=key[1])
+    return eye[labels]
+
+def collect_stats(params, inputs, rs):
+    """Estimate the Kronecker factors (A, G) of each layer's Fisher block
+       from one minibatch, with targets sampled from the model. The deltas
+       (gradients of the sampled log-likelihood with respect to each layer's
+       pre-activations) are backpropagated in closed form, so no reverse-mode
+       trace and no throwaway per-example bias tensors are needed."""
+    activations = [inputs]
+    for W, b in params:
+        outputs = np.dot(activations[-1], W) + b
+        activations.append(np.tanh(outputs))
+    targets = sample_discrete_from_log(outputs, rs)
+    deltas = [targets - softmax(outputs)]
+    for (W, b), h in zip(params[:0:-1], activations[-2:0:-1]):
+        deltas.append(np.dot(deltas[-1], W.T) * (1. - h**2))
+    deltas.reverse()
+    N = inputs.shape[0]
+    return ([homog_outer(a) / N for a in activations[:-1]],
+            [sym_outer(d) / N for d in deltas])
+
+def update_stats(stats, new_stats, decay):
+    """Exponential moving average of the (A, G) statistics, updated in place.
+       Stats are stored structure-of-arrays -- one list of A factors, one
+       list of G factors -- and new_stats is freshly allocated by
+       collect_stats, so both sides can be scaled in place and the update
+       makes no allocations at all."""
+    def ema(olds, news):
+        for old, new in zip(olds, news):
+            old *= decay
+            new *= 1. - decay
+            old += new
+    ema(stats[0], new_stats[0])
+    ema(stats[1], new_stats[1])
+    return stats
+
+def update_factor_estimates(factors, stats, decay):
+    """Fold the current statistics into the slowly-moving factor estimates
+       from which the preconditioner is computed. Updates factors in place;
+       stats stays live, so only its scaled copy is temporary."""
+    def ema(olds, news):
+        for old, new in zip(olds, news):
+            old *= decay
+            old += (1. - decay) * new
+    ema(factors[0], stats[0])
+    ema(factors[1], stats[1])
+    return factors
+
+
+### Computing and applying the preconditioner
+
+def compute_precond(factors, lmbda):
+    """Eigendecompose the Kronecker factors of every layer and fold the
+       damping into the eigenvalues up front. The damping is split across
+       the two factors in proportion to pi = sqrt(mean eig of A / mean eig
+       of G), the factored Tikhonov scheme of Martens & Grosse, sec. 6.3,
+       and the reciprocal denominators are precomputed so that each apply
+       is a single elementwise multiply in the eigenbasis."""
+    U_As, U_Gs, scales = [], [], []
+    for A, G in zip(*factors):
+        lam_A, U_A = np.linalg.eigh(A)
+        lam_G, U_G = np.linalg.eigh(G)
+        pi = np.sqrt((np.trace(A) / A.shape[0]) / (np.trace(G) / G.shape[0]))
+        scales.append(1. / np.outer(lam_A + np.sqrt(lmbda) * pi,
+                                    lam_G + np.sqrt(lmbda) / pi))
+        U_As.append(U_A)
+        U_Gs.append(U_G)
+    return U_As, U_Gs, scales
+
+_einsum_paths = {}
+
+def einsum_cached(spec, *ops):
+    """np.einsum with the contraction path planned once per (spec, shapes)
+       and cached, so steady-state applies pay only for the GEMMs."""
+    key = (spec,) + tuple(np.shape(op) for op in ops)
+    path = _einsum_paths.get(key)
+    if path is None:
+        path = _einsum_paths[key] = np.einsum_path(spec, *ops,
+                                                   optimize='optimal')[0]
+    return np.einsum(spec, *ops, optimize=path)
+
+def apply_preconditioner(precond, gradient_stack):
+    """Approximate natural gradients for a whole stack of gradient pytrees.
+       The preconditioner is constant between refreshes, so the T applies
+       batch into one pair of einsums per layer instead of T serial pairs;
+       in the Kronecker eigenbasis the damped inverse is still an
+       elementwise multiply by the precomputed reciprocal denominators."""
+    U_As, U_Gs, scales = precond
+    result = [[] for _ in gradient_stack]
+    for l, (U_A, U_G, scale) in enumerate(zip(U_As, U_Gs, scales)):
+        Wb = np.array([np.concatenate((g[l][0], g[l][1][None, :]), axis=0)
+                       for g in gradient_stack])
+        proj = einsum_cached('ai,tab,bj->tij', U_A, Wb, U_G)
+        proj *= scale
+        nat = einsum_cached('ia,tab,jb->tij', U_A, proj, U_G)
+        for t in range(len(gradient_stack)):
+            result[t].append((nat[t, :-1], nat[t, -1]))
+    return result
+
+
+### Fisher matrices for checking the KFAC approximation on small models
+
+def flat_mlp(params):
+    """Version of mlp that takes a flattened parameter vector. Flattening
+       walks the whole parameter pytree, so callers should do this once and
+       reuse the returned function rather than re-flattening per call."""
+    flat_params, unflatten = flatten(params)
+    return flat_params, lambda fp, inputs: mlp(unflatten(fp), inputs)
+
+def exact_fisher(flat_params, fun, inputs):
+    """Exact Fisher of the model's predictive distribution, averaged over
+       inputs, as a dense matrix over the flattened parameters. fun is the
+       flat-parameter forward pass from flat_mlp."""
+    J = jacobian(fun)(flat_params, inputs)        # (N, K, P), one traced pass
+    probs = softmax(fun(flat_params, inputs))
+    # Hessian of logsumexp in closed form: diag(p) - p p^T, batched over rows.
+    F_R = probs[:, :, None] * (np.eye(probs.shape[1]) - probs[:, None, :])
+    F = np.einsum('nji,njk,nkl->il', J, F_R, J, optimize=True)
+    return F / inputs.shape[0]
+
+def montecarlo_grads(flat_params, fun, inputs, num_samples, rs):
+    """Per-sample log-likelihood gradients, one row per sampled target set,
+       as a (num_samples, P) matrix. fun is the flat-parameter forward pass
+       from flat_mlp."""
+    logprobs = fun(flat_params, inputs)
+    all_targets = np.array([sample_discrete_from_log(logprobs, rs)
+                            for i in range(num_samples)])
+    def sample_logliks(fp):
+        logits = fun(fp, inputs)
+        logprobs = logits - logsumexp(logits, axis=-1, keepdims=True)
+        return np.einsum('snk,nk->s', all_targets, logprobs)
+    return jacobian(sample_logliks)(flat_params)
+
+def montecarlo_fisher(flat_params, fun, inputs, num_samples, rs):
+    """Monte Carlo estimate of the Fisher: sample targets from the model's
+       predictive distribution and average outer products of the resulting
+       log-likelihood gradients."""
+    G = montecarlo_grads(flat_params, fun, inputs, num_samples, rs)
+    return sym_outer(G) / (num_samples * inputs.shape[0])
+
+def montecarlo_fisher_matvec(flat_params, fun, inputs, num_samples, rs):
+    """Matrix-free version of montecarlo_fisher: returns a function mapping
+       v to F v = G^T (G v) / (num_samples N), two thin matvecs against the
+       gradient matrix, so the dense (P, P) Fisher is never materialized."""
+    G = montecarlo_grads(flat_params, fun, inputs, num_samples, rs)
+    scale = 1. / (num_samples * inputs.shape[0])
+    return lambda v: scale * np.dot(G.T, np.dot(G, v))
+
+def kfac_approx_fisher_matvec(factors):
+    """Matrix-free KFAC approximate Fisher: returns a function applying the
+       block-diagonal approximation to a flat vector, layer by layer, via
+       the reshape trick (A kron G) v = vec(A V G^T). Each layer costs two
+       small matmuls and O(P) memory; kron(A, G) is never formed (for the
+       MNIST input layer alone it would have 785^2 * 201^2 entries)."""
+    As, Gs = factors
+    def matvec(v):
+        pieces, i = [], 0
+        for A, G in zip(As, Gs):
+            V = np.reshape(v[i:i + A.shape[0] * G.shape[0]],
+                           (A.shape[0], G.shape[0]))
+            pieces.append(np.dot(A, np.dot(V, G.T)).ravel())
+            i += V.size
+        return np.concatenate(pieces)
+    return matvec
+
+def kfac_approx_fisher(factors):
+    """Dense version of the KFAC approximation: a block-diagonal matrix whose
+       blocks are Kronecker products of the per-layer factors. Only viable
+       for small models; use kfac_approx_fisher_matvec otherwise."""
+    As, Gs = factors
+    return scipy.linalg.block_diag(*[np.kron(A, G) for A, G in zip(As, Gs)])
+
+
+### KFAC training loop
+
+def kfac(objective, get_batch, params, callback=None, num_iters=100,
+         step_size=0.01, lmbda=0.1, momentum=0.9, stat_decay=0.95,
+         sample_period=1, reestimate_period=5, update_precond_period=20,
+         rs=npr.RandomState(0)):
+    """Train params by preconditioned SGD with momentum, where the
+       preconditioner is the inverse of the KFAC approximate Fisher. The
+       factors (and hence the preconditioner) are constant within each block
+       of reestimate_period iterations, so the loop processes one block at a
+       time: the block's statistics and gradients are all evaluated at the
+       block-start parameters (stale gradients, traded for batching), the
+       gradients are preconditioned together with one batched einsum pair
+       per layer, and only the cheap elementwise momentum recurrence runs
+       sequentially."""
+    objective_grad = grad(objective)
+    # The update loop writes into params and velocity in place, so take
+    # ownership of the arrays up front.
+    params = [(W.copy(), b.copy()) for W, b in params]
+    velocity = [(np.zeros_like(W), np.zeros_like(b)) for W, b in params]
+
+    stats = factors = precond = None
+    for i0 in range(0, num_iters, reestimate_period):
+        block = range(i0, min(i0 + reestimate_period, num_iters))
+        for i in block:
+            if i % sample_period == 0:
+                new_stats = collect_stats(params, get_batch(i), rs)
+                stats = new_stats if stats is None else \
+                        update_stats(stats, new_stats, stat_decay)
+        # Copy on first use: both EMAs update their arrays in place.
+        factors = ([A.copy() for A in stats[0]],
+                   [G.copy() for G in stats[1]]) if factors is None else \
+                  update_factor_estimates(factors, stats, stat_decay)
+        # i0 only visits multiples of reestimate_period, so refresh whenever
+        # a refresh point falls anywhere within this block, not only when
+        # the block start lands exactly on one.
+        if precond is None or i0 % update_precond_period < reestimate_period:
+            precond = compute_precond(factors, lmbda)
+        gradients = [objective_grad(params, i) for i in block]
+        natgrads = apply_preconditioner(precond, gradients)
+        for t, i in enumerate(block):
+            # Fused momentum and parameter update: one in-place
+            # scale-and-add pass per array, with the throwaway natural
+            # gradient scaled in place, so the update allocates nothing.
+            for (W, b), (vW, vb), (dW, db) in zip(params, velocity,
+                                                  natgrads[t]):
+                for x, v, d in ((W, vW, dW), (b, vb, db)):
+                    d *= step_size
+                    v *= momentum
+                    v -= d
+                    x += v
+            if callback: callback(params, i, gradients[t])
+    return params
+
+
+def check_fisher_approximations(layer_sizes=[4, 3, 2], N=20, num_samples=1000,
+                                rs=npr.RandomState(0)):
+    """Compare the KFAC approximate Fisher against exact and Monte Carlo
+       Fishers on a model small enough to form them densely."""
+    params = init_random_params(1.0, layer_sizes, rs)
+    inputs = np.asarray(rs.randn(N, layer_sizes[0]), dtype=np.float32)
+    flat_params, fun = flat_mlp(params)   # flatten once, share the unraveler
+    F_exact = exact_fisher(flat_params, fun, inputs)
+    F_mc = montecarlo_fisher(flat_params, fun, inputs, num_samples, rs)
+    factors = collect_stats(params, inputs, rs)
+    F_kfac = kfac_approx_fisher(factors)
+    relerr = lambda X, Y: np.linalg.norm(X - Y) / np.linalg.norm(X)
+    print("Monte Carlo Fisher relative error: {}".format(relerr(F_exact, F_mc)))
+    print("KFAC Fisher relative error:        {}".format(relerr(F_exact, F_kfac)))
+    fisher_vp = montecarlo_fisher_matvec(flat_params, fun, inputs,
+                                         num_samples, rs)
+    v = rs.randn(flat_params.size)
+    print("Fisher matvec relative error:      {}".format(
+        relerr(np.dot(F_exact, v), fisher_vp(v))))
+    kfac_vp = kfac_approx_fisher_matvec(factors)
+    print("KFAC matvec relative error:        {}".format(
+        relerr(np.dot(F_kfac, v), kfac_vp(v))))
+
+
+if __name__ == '__main__':
+    check_fisher_approximations()
+
+    # Model and training parameters
+    layer_sizes = [784, 200, 100, 10]
+    param_scale = 0.1
+    batch_size = 256
+    num_epochs = 5
+
+    print("Loading training data...")
+    N, train_images, train_labels, test_images, test_labels = load_mnist()
+    train_images = train_images.astype(np.float32)
+    train_labels = train_labels.astype(np.float32)
+    test_images  = test_images.astype(np.float32)
+
+    init_params = init_random_params(param_scale, layer_sizes)
+
+    num_batches = int(np.ceil(len(train_images) / batch_size))
+    def batch_indices(iter):
+        idx = iter % num_batches
+        return slice(idx * batch_size, (idx+1) * batch_size)
+
+    def get_batch(iter):
+        return train_images[batch_indices(iter)]
+
+    def objective(params, iter):
+        idx = batch_indices(iter)
+        return -log_likelihood(mlp(params, train_images[idx]),
+                               train_labels[idx]) / batch_size
+
+    train_classes = np.argmax(train_labels, axis=1)
+    test_classes  = np.argmax(test_labels, axis=1)
+
+    print("     Epoch     |    Train accuracy  |       Test accuracy  ")
+    def print_perf(params, iter, gradient):
+        if iter % num_batches == 0:
+            train_acc = accuracy(params, train_images, train_classes)
+            test_acc  = accuracy(params, test_images, test_classes)
+            print("{:15}|{:20}|{:20}".format(iter//num_batches, train_acc, test_acc))
+
+    optimized_params = kfac(objective, get_batch, init_params,
+                            callback=print_perf,
+                            num_iters=num_epochs * num_batches)